@@ -57,6 +57,7 @@ fi
 echo -e "${CYAN}[1/5] 依存ライブラリを準備中...${NC}"
 "$PYTHON" -m pip install --quiet --upgrade pip
 "$PYTHON" -m pip install --quiet flask requests pywebview pyinstaller Pillow
+"$PYTHON" -m pip install --quiet waitress orjson 2>/dev/null || true
 "$PYTHON" -m pip install --quiet duckduckgo-search trafilatura beautifulsoup4 lxml 2>/dev/null || true
 "$PYTHON" -m pip install --quiet chromadb sentence-transformers 2>/dev/null || true
 
@@ -99,12 +100,14 @@ fi
   --hidden-import flask \
   --hidden-import werkzeug \
   --hidden-import werkzeug.serving \
+  --hidden-import waitress \
   --hidden-import jinja2 \
   --hidden-import click \
   --hidden-import sqlite3 \
   --hidden-import requests \
   --hidden-import urllib3 \
   --hidden-import certifi \
+  --hidden-import orjson \
   --hidden-import webview \
   --hidden-import webview.platforms.cocoa \
   --hidden-import chromadb \
@@ -9,26 +9,36 @@
 
 import os
 import sys
-import io
-import re
-import ast
 import json
-import uuid
 import time
+import errno
+import select
+import selectors
 import socket
 import shutil
+import hashlib
 import sqlite3
 import logging
 import threading
-import traceback
 import subprocess
-import webbrowser
 from pathlib import Path
 from datetime import datetime
-from contextlib import redirect_stdout, redirect_stderr
 
 import requests
 from flask import Flask, Response, jsonify, request, stream_with_context
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler, make_server
+
+try:
+    import orjson
+
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    _loads = json.loads
 
 APP_SUPPORT = os.path.expanduser("~/Library/Application Support/NexusPro")
 os.makedirs(APP_SUPPORT, exist_ok=True)
@@ -45,7 +55,8 @@ logging.basicConfig(
 logger = logging.getLogger("nexus_pro")
 
 APP_PORT = 7100
-OLLAMA = "http://localhost:11434"
+OLLAMA_PORT = 11434
+OLLAMA = f"http://localhost:{OLLAMA_PORT}"
 MODEL_NAME = "qwen2.5-coder:7b"
 OLLAMA_SETUP_FLAG = Path(APP_SUPPORT) / "ollama_setup_attempted.flag"
 MODEL_READY_FLAG = Path(APP_SUPPORT) / f"model_ready_{MODEL_NAME.replace(':', '_')}.flag"
@@ -53,6 +64,32 @@ MODEL_READY_FLAG = Path(APP_SUPPORT) / f"model_ready_{MODEL_NAME.replace(':', '_
 flask_app = Flask(__name__)
 DB_PATH = Path(APP_SUPPORT) / "nexus_pro.db"
 _tlocal = threading.local()
+_server = None
+_server_ready = threading.Event()
+_settings_cache: dict[str, str] = {}
+_settings_lock = threading.Lock()
+
+STATUS_TTL = 1.5
+_status_cache = {"t": 0.0, "ok": False, "models": []}
+_status_lock = threading.Lock()
+
+_NODELAY = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)]
+
+
+class _NoDelayAdapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = _NODELAY
+        super().init_poolmanager(*args, **kwargs)
+
+
+class _NoDelayRequestHandler(WSGIRequestHandler):
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+_http = requests.Session()
+_http.mount("http://", _NoDelayAdapter(pool_connections=4, pool_maxsize=16, max_retries=0))
 
 
 def _resource_base() -> Path:
@@ -65,46 +102,148 @@ def bundled_model_dir() -> Path:
     return _resource_base() / "bundled_models" / MODEL_NAME
 
 
-def _wait_server(port: int, timeout: int = 25) -> bool:
-    end = time.time() + timeout
-    while time.time() < end:
+_KQ_DEADLINE = 1
+_KQ_RETRY = 2
+_KQ_RETRY_MS = 250
+
+
+def _connect_nonblocking(port: int):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setblocking(False)
+    return s, s.connect_ex(("127.0.0.1", port))
+
+
+def _probe_port(port: int, timeout: float = 1.0) -> int:
+    s, rc = _connect_nonblocking(port)
+    with s:
+        if rc == errno.EINPROGRESS:
+            _, w, _ = select.select([], [s], [], timeout)
+            rc = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) if w else errno.ETIMEDOUT
+    return rc
+
+
+def _wait_port_kqueue(port: int, timeout: float, pid: int | None = None) -> bool:
+    kq = select.kqueue()
+    try:
+        changes = [select.kevent(_KQ_DEADLINE, select.KQ_FILTER_TIMER, select.KQ_EV_ADD | select.KQ_EV_ONESHOT, data=int(timeout * 1000))]
+        if pid is not None:
+            changes.append(select.kevent(pid, select.KQ_FILTER_PROC, select.KQ_EV_ADD | select.KQ_EV_ONESHOT, fflags=select.KQ_NOTE_EXIT))
         try:
-            with socket.create_connection(("127.0.0.1", port), 1):
-                return True
-        except OSError:
-            time.sleep(0.2)
-    return False
+            kq.control(changes, 0)
+        except ProcessLookupError:
+            return False
+        while True:
+            s, rc = _connect_nonblocking(port)
+            try:
+                if rc == 0:
+                    return True
+                # 未リッスン時は即 ECONNREFUSED になるため、再試行間隔もタイマーで待つ
+                changes = [select.kevent(_KQ_RETRY, select.KQ_FILTER_TIMER, select.KQ_EV_ADD | select.KQ_EV_ONESHOT, data=_KQ_RETRY_MS)]
+                if rc == errno.EINPROGRESS:
+                    changes.append(select.kevent(s.fileno(), select.KQ_FILTER_WRITE, select.KQ_EV_ADD | select.KQ_EV_ONESHOT))
+                kq.control(changes, 0)
+                retry = False
+                while not retry:
+                    for ev in kq.control(None, 4, None):
+                        if ev.filter == select.KQ_FILTER_PROC:
+                            return False
+                        if ev.filter == select.KQ_FILTER_TIMER and ev.ident == _KQ_DEADLINE:
+                            return False
+                        if ev.filter == select.KQ_FILTER_WRITE:
+                            if s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                                return True
+                        elif ev.ident == _KQ_RETRY:
+                            retry = True
+            finally:
+                s.close()
+    finally:
+        kq.close()
+
+
+def _wait_server(timeout: int = 25) -> bool:
+    # run_server() がリッスン開始直後にセットするため、接続の再試行は不要
+    return _server_ready.wait(timeout) and _server is not None
+
+
+def _log_tail(lines: int = 20) -> str:
+    try:
+        with open(STARTUP_LOG_PATH, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 8192))
+            return b"\n".join(f.read().splitlines()[-lines:]).decode("utf-8", "replace")
+    except OSError:
+        return ""
+
 
+OUTPUT_PENDING_MAX = 65536
 
-def _port_in_use(port: int) -> bool:
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        return s.connect_ex(("127.0.0.1", port)) == 0
+
+def _log_output_line(name: str, line: bytes):
+    line = line.removesuffix(b"\r")
+    if line.strip():
+        logger.info("%s: %s", name, line.decode("utf-8", "replace"))
 
 
 def _run_logged(cmd: list[str], cwd: str | None = None, timeout: int = 1800):
     logger.info("実行: %s", " ".join(cmd))
-    p = subprocess.run(cmd, cwd=cwd, capture_output=True, text=True, timeout=timeout)
+    deadline = time.monotonic() + timeout
+    pending = {"stdout": b"", "stderr": b""}
+    with subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as p, selectors.DefaultSelector() as sel:
+        sel.register(p.stdout, selectors.EVENT_READ, "stdout")
+        sel.register(p.stderr, selectors.EVENT_READ, "stderr")
+        while sel.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                p.kill()
+                raise subprocess.TimeoutExpired(cmd, timeout)
+            for key, _ in sel.select(remaining):
+                name = key.data
+                data = os.read(key.fd, 65536)
+                if not data:
+                    sel.unregister(key.fileobj)
+                    _log_output_line(name, pending[name])
+                    continue
+                *lines, rest = (pending[name] + data).split(b"\n")
+                for line in lines:
+                    _log_output_line(name, line)
+                # 改行待ちの進捗表示は \r 上書きの最後の状態だけ保持する
+                cut = rest.rfind(b"\r", 0, len(rest.rstrip(b"\r")))
+                pending[name] = rest[cut + 1 :][-OUTPUT_PENDING_MAX:]
+        try:
+            p.wait(timeout=max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            p.kill()
+            raise
     logger.info("終了コード: %s", p.returncode)
-    if p.stdout:
-        logger.info("stdout:\n%s", p.stdout[-5000:])
-    if p.stderr:
-        logger.info("stderr:\n%s", p.stderr[-5000:])
-    return p
+    return subprocess.CompletedProcess(cmd, p.returncode)
+
+
+def ollama_status() -> dict:
+    with _status_lock:
+        if time.monotonic() - _status_cache["t"] < STATUS_TTL:
+            return dict(_status_cache)
+        ok, models = False, []
+        try:
+            r = _http.get(f"{OLLAMA}/api/tags", timeout=2)
+            ok = True
+            models = [m["name"] for m in r.json().get("models", [])]
+        except Exception:
+            pass
+        _status_cache.update(t=time.monotonic(), ok=ok, models=models)
+        return dict(_status_cache)
+
+
+def invalidate_status():
+    with _status_lock:
+        _status_cache["t"] = 0.0
 
 
 def ollama_ok() -> bool:
-    try:
-        requests.get(f"{OLLAMA}/api/tags", timeout=2)
-        return True
-    except Exception:
-        return False
+    return ollama_status()["ok"]
 
 
 def list_models():
-    try:
-        return [m["name"] for m in requests.get(f"{OLLAMA}/api/tags", timeout=3).json().get("models", [])]
-    except Exception:
-        return []
+    return list(ollama_status()["models"])
 
 
 def ensure_ollama_installed():
@@ -123,6 +262,8 @@ def ensure_ollama_installed():
 
     installer_url = "https://ollama.com/download/Ollama-darwin.zip"
     try:
+        import webbrowser
+
         webbrowser.open(installer_url)
         logger.info("Ollama インストーラURLを開きました: %s", installer_url)
     except Exception:
@@ -158,7 +299,22 @@ def ensure_ollama_running(retry_seconds: int = 30):
         logger.exception("ollama serve 起動失敗")
         return False, f"Ollama の自動起動に失敗しました: {e}\nログ保存先: {STARTUP_LOG_PATH}"
 
+    try:
+        ready = _wait_port_kqueue(OLLAMA_PORT, retry_seconds, pid=p.pid)
+    except (AttributeError, OSError):
+        logger.debug("kqueue 待機不可。ポーリングで待機します。", exc_info=True)
+    else:
+        if ready:
+            invalidate_status()
+            logger.info("Ollama 起動待ち: OK")
+            return True, ""
+        if p.poll() is not None:
+            logger.error("ollama serve が終了しました (code=%s)\n%s", p.returncode, _log_tail())
+            return False, f"Ollama が起動直後に終了しました (code={p.returncode})。\nログ保存先: {STARTUP_LOG_PATH}"
+        return False, f"Ollama 起動待ちがタイムアウトしました。\nログ保存先: {STARTUP_LOG_PATH}"
+
     for _ in range(retry_seconds):
+        invalidate_status()
         if ollama_ok():
             logger.info("Ollama 起動待ち: OK")
             return True, ""
@@ -178,6 +334,7 @@ def ensure_model_ready():
     if modelfile.exists():
         try:
             p = _run_logged(["ollama", "create", MODEL_NAME, "-f", str(modelfile)], cwd=str(model_dir), timeout=3600)
+            invalidate_status()
             if p.returncode != 0:
                 logger.warning("同梱モデル create に失敗。pull フォールバックを試行します。")
             elif MODEL_NAME in list_models():
@@ -194,6 +351,7 @@ def ensure_model_ready():
 
     try:
         p = _run_logged(["ollama", "pull", MODEL_NAME], timeout=3600)
+        invalidate_status()
         if p.returncode != 0:
             return False, f"モデル準備に失敗しました（同梱 create / pull）。\nログ保存先: {STARTUP_LOG_PATH}"
     except Exception as e:
@@ -208,15 +366,26 @@ def ensure_model_ready():
     return False, f"モデル準備後も登録確認できませんでした。\nログ保存先: {STARTUP_LOG_PATH}"
 
 
+DB_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA mmap_size=268435456;
+PRAGMA cache_size=-65536;
+"""
+
+
 def get_db():
     if not hasattr(_tlocal, "c"):
         _tlocal.c = sqlite3.connect(str(DB_PATH), check_same_thread=False)
         _tlocal.c.row_factory = sqlite3.Row
+        _tlocal.c.executescript(DB_PRAGMAS)
     return _tlocal.c
 
 
 def init_db():
-    c = sqlite3.connect(str(DB_PATH))
+    c = sqlite3.connect(str(DB_PATH), check_same_thread=False)
+    c.executescript(DB_PRAGMAS)
     c.executescript(
         """
         CREATE TABLE IF NOT EXISTS sessions(id TEXT PRIMARY KEY, title TEXT, model TEXT, created_at TEXT, last_active TEXT);
@@ -228,26 +397,78 @@ def init_db():
         """
     )
     c.commit()
+    with _settings_lock:
+        _settings_cache.clear()
+        _settings_cache.update(c.execute("SELECT key, value FROM settings").fetchall())
     c.close()
 
 
 def dbg(k):
-    r = get_db().execute("SELECT value FROM settings WHERE key=?", (k,)).fetchone()
-    return r["value"] if r else None
+    return _settings_cache.get(k)
+
+
+INSERT_MESSAGE_SQL = "INSERT INTO messages(session_id, role, content, created_at) VALUES(?, ?, ?, ?)"
+
+
+def add_messages(session_id, turns):
+    now = datetime.now().isoformat()
+    c = get_db()
+    with c:
+        c.execute("BEGIN IMMEDIATE")
+        c.executemany(INSERT_MESSAGE_SQL, [(session_id, role, content, now) for role, content in turns])
+
+
+def set_setting(k, v):
+    with _settings_lock:
+        c = get_db()
+        with c:
+            c.execute("INSERT OR REPLACE INTO settings VALUES(?, ?)", (k, str(v)))
+        _settings_cache[k] = str(v)
+
+
+def _iter_ndjson(resp):
+    buf = b""
+    for data in resp.iter_content(chunk_size=65536):
+        buf += data
+        if b"\n" not in data:
+            continue
+        *lines, buf = buf.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield _loads(line)
+    if buf.strip():
+        yield _loads(buf)
+
+
+def _chat_chunks(resp):
+    resp.raise_for_status()
+    for d in _iter_ndjson(resp):
+        yield d.get("message", {}).get("content", ""), d.get("done", False)
 
 
 def stream_ollama(model, messages, system, temp=0.7):
-    resp = requests.post(
+    resp = _http.post(
         f"{OLLAMA}/api/chat",
         json={"model": model, "messages": messages, "stream": True, "options": {"temperature": temp}, "system": system},
+        headers={"Accept-Encoding": "identity"},
         stream=True,
         timeout=300,
     )
-    resp.raise_for_status()
-    for line in resp.iter_lines():
-        if line:
-            d = json.loads(line)
-            yield d.get("message", {}).get("content", ""), d.get("done", False)
+    yield from _chat_chunks(resp)
+
+
+_CHAT_HEADERS = {"Accept-Encoding": "identity", "Content-Type": "application/json"}
+_CHAT_SINGLE_MID = b',"stream":true,"options":{"temperature":'
+_CHAT_SINGLE_USER = b'},"messages":[{"role":"user","content":'
+_CHAT_SINGLE_POST = b"}]}"
+
+
+def stream_ollama_single(model, user_msg, temp=0.7):
+    body = b"".join(
+        [b'{"model":', _dumps(model), _CHAT_SINGLE_MID, _dumps(temp), _CHAT_SINGLE_USER, _dumps(user_msg), _CHAT_SINGLE_POST]
+    )
+    resp = _http.post(f"{OLLAMA}/api/chat", data=body, headers=_CHAT_HEADERS, stream=True, timeout=300)
+    yield from _chat_chunks(resp)
 
 
 HTML = """<!DOCTYPE html>
@@ -255,16 +476,27 @@ HTML = """<!DOCTYPE html>
 <body style='background:#06060d;color:#dde2f8;font-family:sans-serif'>
 <h2>NEXUS PRO</h2><p>localhost:7100 で起動中</p>
 </body></html>"""
+_HTML_BYTES = HTML.encode("utf-8")
+_HTML_ETAG = hashlib.blake2b(_HTML_BYTES, digest_size=8).hexdigest()
+_HTML_HEADERS = {"ETag": f'"{_HTML_ETAG}"', "Cache-Control": "public, max-age=3600, immutable"}
+
+
+_SSE_PRE = b'data: {"text":'
+_SSE_POST = b"}\n\n"
+_SSE_DONE = b'data: {"done":true}\n\n'
 
 
 @flask_app.route("/")
 def index():
-    return HTML
+    if request.if_none_match.contains_weak(_HTML_ETAG):
+        return Response(status=304, headers=_HTML_HEADERS)
+    return Response(_HTML_BYTES, mimetype="text/html", headers=_HTML_HEADERS)
 
 
 @flask_app.route("/api/status")
 def status():
-    return jsonify({"ollama": ollama_ok(), "online": True, "models": list_models() if ollama_ok() else []})
+    st = ollama_status()
+    return jsonify({"ollama": st["ok"], "online": True, "models": st["models"]})
 
 
 @flask_app.route("/api/chat", methods=["POST"])
@@ -278,24 +510,60 @@ def chat():
         return jsonify({"error": f"Ollama が起動していません。\nログ保存先: {STARTUP_LOG_PATH}"}), 503
 
     def gen():
-        full = ""
         try:
-            for chunk, done in stream_ollama(model, [{"role": "user", "content": msg}], "", float(dbg("temperature") or 0.7)):
-                full += chunk
-                yield f"data: {json.dumps({'text': chunk})}\n\n"
+            for chunk, done in stream_ollama_single(model, msg, float(dbg("temperature") or 0.7)):
+                yield _SSE_PRE + _dumps(chunk) + _SSE_POST
                 if done:
                     break
-            yield f"data: {json.dumps({'done': True})}\n\n"
+            yield _SSE_DONE
         except Exception as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            yield b"data: " + _dumps({"error": str(e)}) + b"\n\n"
+
+    resp = Response(stream_with_context(gen()), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    resp.direct_passthrough = True
+    return resp
+
+
+def _create_server():
+    try:
+        from waitress import create_server
+    except ImportError:
+        logger.warning("waitress 未インストール。Flask 開発サーバーで起動します。")
+        logger.info("Flask起動（7100）")
+        return make_server("127.0.0.1", APP_PORT, flask_app, threaded=True, request_handler=_NoDelayRequestHandler)
 
-    return Response(stream_with_context(gen()), mimetype="text/event-stream")
+    logger.info("Flask起動（7100, waitress）")
+    # waitress は既定の socket_options で受け付けソケットに TCP_NODELAY を設定する
+    return create_server(flask_app, host="127.0.0.1", port=APP_PORT, threads=16, channel_timeout=600, asyncore_use_poll=True)
 
 
 def run_server():
-    init_db()
-    logger.info("Flask起動（7100）")
-    flask_app.run(host="127.0.0.1", port=APP_PORT, debug=False, threaded=True, use_reloader=False)
+    global _server
+    try:
+        init_db()
+        _server = _create_server()
+    finally:
+        _server_ready.set()
+    if isinstance(_server, BaseWSGIServer):
+        _server.serve_forever()
+    else:
+        _server.run()
+
+
+def stop_server():
+    srv = _server
+    if srv is None:
+        return
+    logger.info("Flask停止")
+    try:
+        if isinstance(srv, BaseWSGIServer):
+            srv.shutdown()
+        else:
+            srv.close()
+    except Exception:
+        logger.exception("Flask 停止処理でエラー")
 
 
 def fail_and_exit(msg: str):
@@ -305,30 +573,7 @@ def fail_and_exit(msg: str):
     sys.exit(1)
 
 
-def main():
-    logger.info("NEXUS PRO 起動開始")
-
-    if _port_in_use(APP_PORT):
-        fail_and_exit(f"ポート {APP_PORT} はすでに使用されています。別プロセスを停止後に再実行してください。")
-
-    ok, err = ensure_ollama_running()
-    if not ok:
-        fail_and_exit(err)
-
-    ok, err = ensure_model_ready()
-    if not ok:
-        fail_and_exit(err)
-
-    t = threading.Thread(target=run_server, daemon=True)
-    t.start()
-
-    url = f"http://127.0.0.1:{APP_PORT}"
-    if not _wait_server(APP_PORT, timeout=30):
-        fail_and_exit("Flask 起動待ちがタイムアウトしました。")
-
-    logger.info("起動完了: %s", url)
-    print(f"[NEXUS PRO] 起動完了: {url}")
-
+def open_window(url: str):
     try:
         import webview
 
@@ -346,16 +591,52 @@ def main():
         )
         webview.start(gui="cocoa", private_mode=False, storage_path=APP_SUPPORT)
     except ImportError:
+        import webbrowser
+
         logger.warning("pywebview 未インストール。ブラウザで開きます。")
         webbrowser.open(url)
         while True:
             time.sleep(1)
     except Exception:
+        import webbrowser
+
         logger.exception("WebView エラー。ブラウザでフォールバック。")
         webbrowser.open(url)
         while True:
             time.sleep(1)
 
 
+def main():
+    logger.info("NEXUS PRO 起動開始")
+
+    if _probe_port(APP_PORT) == 0:
+        fail_and_exit(f"ポート {APP_PORT} はすでに使用されています。別プロセスを停止後に再実行してください。")
+
+    ok, err = ensure_ollama_running()
+    if not ok:
+        fail_and_exit(err)
+
+    ok, err = ensure_model_ready()
+    if not ok:
+        fail_and_exit(err)
+
+    t = threading.Thread(target=run_server, daemon=True)
+    t.start()
+
+    url = f"http://127.0.0.1:{APP_PORT}"
+    if not _wait_server(timeout=30):
+        fail_and_exit("Flask の起動に失敗しました（起動エラーまたはタイムアウト）。")
+
+    logger.info("起動完了: %s", url)
+    print(f"[NEXUS PRO] 起動完了: {url}")
+
+    try:
+        open_window(url)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_server()
+
+
 if __name__ == "__main__":
     main()